@@ -7,8 +7,10 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
 import os
+import shlex
 import subprocess
 import sys
+from contextlib import contextmanager
 from shutil import which
 
 from migen.fhdl.structure import _Fragment
@@ -32,39 +34,91 @@ _yosys_template = [
 ]
 
 def _yosys_import_sources(platform):
-    includes = ""
+    includes = "".join(" -I" + path for path in platform.verilog_include_paths)
     reads = []
-    for path in platform.verilog_include_paths:
-        includes += " -I" + path
+    seen  = set()
     for filename, language, library in platform.sources:
+        # Only read each source once, even if added several times.
+        if filename in seen:
+            continue
+        seen.add(filename)
         # yosys has no such function read_systemverilog
         if language == "systemverilog":
             language = "verilog -sv"
-        reads.append("read_{}{} {}".format(
-            language, includes, filename))
+        reads.append(f"read_{language}{includes} {filename}")
     return "\n".join(reads)
 
 def _build_yosys(template, platform, nowidelut, abc9, build_name):
-    ys = []
+    ys         = []
+    read_files = _yosys_import_sources(platform)
+    nwl        = "-nowidelut" if nowidelut else ""
+    abc        = "-abc9" if abc9 else ""
     for l in template:
+        # Only format lines with placeholders.
+        if "{" not in l:
+            ys.append(l)
+            continue
         ys.append(l.format(
             build_name = build_name,
-            nwl        = "-nowidelut" if nowidelut else "",
-            abc        = "-abc9" if abc9 else "",
-            read_files = _yosys_import_sources(platform)
+            nwl        = nwl,
+            abc        = abc,
+            read_files = read_files
         ))
     tools.write_to_file(build_name + ".ys", "\n".join(ys))
 
 # Script -------------------------------------------------------------------------------------------
 
+# Entries are argv lists, tuples of argv lists (piped together, sequentially executed on Windows)
+# or command lines as strings (shell syntax).
 _build_template = [
-    "yosys -l {build_name}.rpt {build_name}.ys",
-    "nextpnr-nexus --json {build_name}.json --pdc {build_name}.pdc --fasm {build_name}.fasm \
-    --device {device} {timefailarg} {ignoreloops} --seed {seed}",
-    "prjoxide pack {build_name}.fasm {build_name}.bit"
+    ["yosys", "-l", "{build_name}.rpt", "{build_name}.ys"],
+    # FASM is passed from nextpnr to prjoxide through stdout/stdin (buffered, see _run_pipeline).
+    (["nextpnr-nexus", "--json", "{build_name}.json", "--pdc", "{build_name}.pdc",
+      "--fasm", "{fasm_out}", "--device", "{device}", "{timefailarg}", "{ignoreloops}",
+      "--seed", "{seed}"],
+     ["prjoxide", "pack", "{fasm_in}", "{build_name}.bit"]),
 ]
 
-def _build_script(source, build_template, build_name, device, timingstrict, ignoreloops, seed):
+def _build_commands(build_template, build_name, device, timingstrict, ignoreloops, seed):
+    windows = sys.platform in ("win32", "cygwin")
+    pipe    = not windows
+    fmt = lambda s: s.format(
+        build_name      = build_name,
+        device          = device,
+        timefailarg     = "--timing-allow-fail" if not timingstrict else "",
+        ignoreloops     = "--ignore-loops" if ignoreloops else "",
+        fail_stmt       = " || exit /b" if windows else "",
+        seed            = seed,
+        fasm_out        = "/dev/stdout" if pipe else f"{build_name}.fasm",
+        fasm_in         = "/dev/stdin"  if pipe else f"{build_name}.fasm",
+    )
+    # Drop disabled optional arguments from argv lists.
+    fmt_argv = lambda argv: [arg for arg in map(fmt, argv) if arg != ""]
+    commands = []
+    for s in build_template:
+        # Command lines given as strings are kept as is (shell syntax), see _run_script.
+        if isinstance(s, str):
+            commands.append(fmt(s))
+        elif isinstance(s, tuple):
+            pipeline = [fmt_argv(argv) for argv in s]
+            if pipe:
+                commands.append(tuple(pipeline))
+            else:
+                commands.extend(pipeline)
+        else:
+            commands.append(fmt_argv(s))
+    return commands
+
+def _quote_command(command):
+    if isinstance(command, str):
+        return command
+    if isinstance(command, tuple):
+        return " | ".join(_quote_command(c) for c in command)
+    if sys.platform in ("win32", "cygwin"):
+        return subprocess.list2cmdline(command)
+    return " ".join(shlex.quote(arg) for arg in command)
+
+def _build_script(source, commands, build_name):
     if sys.platform in ("win32", "cygwin"):
         script_ext = ".bat"
         script_contents = "@echo off\nrem Autogenerated by LiteX / git: " + tools.get_litex_git_revision() + "\n\n"
@@ -72,36 +126,71 @@ def _build_script(source, build_template, build_name, device, timingstrict, igno
     else:
         script_ext = ".sh"
         script_contents = "# Autogenerated by LiteX / git: " + tools.get_litex_git_revision() + "\nset -e\n"
+        script_contents += "set -o pipefail\n"
         fail_stmt = ""
 
-    for s in build_template:
-        s_fail = s + "{fail_stmt}\n"  # Required so Windows scripts fail early.
-        script_contents += s_fail.format(
-            build_name      = build_name,
-            device          = device,
-            timefailarg     = "--timing-allow-fail" if not timingstrict else "",
-            ignoreloops     = "--ignore-loops" if ignoreloops else "",
-            fail_stmt       = fail_stmt,
-            seed            = seed,
-        )
+    # {fail_stmt} is required on each line so Windows scripts fail early.
+    script_contents += "".join(_quote_command(command) + fail_stmt + "\n" for command in commands)
     script_file = "build_" + build_name + script_ext
     tools.write_to_file(script_file, script_contents, force_unix=False)
 
     return script_file
 
-def _run_script(script):
-    if sys.platform in ("win32", "cygwin"):
-        shell = ["cmd", "/c"]
-    else:
-        shell = ["bash"]
-
-    if which("yosys") is None or which("nextpnr-nexus") is None:
-        msg = "Unable to find Yosys/Nextpnr toolchain, please:\n"
-        msg += "- Add Yosys/Nextpnr toolchain to your $PATH."
+def _run_pipeline(commands):
+    # Each command's output is buffered and only fed to the next command once it succeeded, so a
+    # failing step (ex: nextpnr routing/timing failure) never lets the next one run on a truncated
+    # input (ex: prjoxide overwriting the bitstream). Note that anything else the command writes
+    # to stdout ends up in the next command's input.
+    data = None
+    for i, command in enumerate(commands):
+        last = (i == len(commands) - 1)
+        proc = subprocess.run(command, input=data, stdout=None if last else subprocess.PIPE)
+        if proc.returncode != 0:
+            raise OSError(f"Error occured during {command[0]}'s execution.")
+        data = proc.stdout
+
+def _run_script(script, commands):
+    # Templates with command lines as strings (shell syntax) are run through the script as before.
+    if any(isinstance(command, str) for command in commands):
+        if which("yosys") is None or which("nextpnr-nexus") is None:
+            msg = "Unable to find Yosys/Nextpnr toolchain, please:\n"
+            msg += "- Add Yosys/Nextpnr toolchain to your $PATH."
+            raise OSError(msg)
+        if sys.platform in ("win32", "cygwin"):
+            shell = ["cmd", "/c"]
+        else:
+            shell = ["bash"]
+        if subprocess.call(shell + [script]) != 0:
+            raise OSError("Error occured during Yosys/Nextpnr's script execution.")
+        return
+
+    # Otherwise check all tools are available...
+    argvs = []
+    for command in commands:
+        argvs += list(command) if isinstance(command, tuple) else [command]
+    missing = [argv[0] for argv in argvs if which(argv[0]) is None]
+    if missing:
+        msg = "Unable to find {} (Yosys/Nextpnr/Prjoxide toolchain), please:\n".format(
+            ", ".join(missing))
+        msg += "- Add Yosys/Nextpnr/Prjoxide toolchain to your $PATH."
         raise OSError(msg)
 
-    if subprocess.call(shell + [script]) != 0:
-        raise OSError("Error occured during Yosys/Nextpnr's script execution.")
+    # ...and directly execute the argv lists/pipelines, without an intermediate shell.
+    for command in commands:
+        if isinstance(command, tuple):
+            _run_pipeline(command)
+        elif subprocess.call(command) != 0:
+            raise OSError(f"Error occured during {command[0]}'s execution.")
+
+@contextmanager
+def _pushd(path):
+    # Change current directory to path, restoring it on exit (even on errors).
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
 
 # LatticeOxideToolchain --------------------------------------------------------------------------
 
@@ -132,42 +221,41 @@ class LatticeOxideToolchain:
 
         # Create build directory
         os.makedirs(build_dir, exist_ok=True)
-        cwd = os.getcwd()
-        os.chdir(build_dir)
-
-        # Finalize design
-        if not isinstance(fragment, _Fragment):
-            fragment = fragment.get_fragment()
-        platform.finalize(fragment)
-
-        # Generate verilog
-        v_output = platform.get_verilog(fragment, name=build_name, **kwargs)
-        named_sc, named_pc = platform.resolve_signals(v_output.ns)
-        top_file = build_name + ".v"
-        v_output.write(top_file)
-        platform.add_source(top_file)
-
-        # Generate design constraints file (.pdc)
-        _build_pdc(named_sc, named_pc, self.clocks, v_output.ns, build_name)
-
-        # Generate Yosys script
-        _build_yosys(self.yosys_template, platform, nowidelut, abc9, build_name)
-
-        # N.B. Radiant does not allow a choice between ES1/production, this is determined
-        # solely by the installed Radiant version. nextpnr/oxide supports both, so we
-        # must choose what we are dealing with
-        device = platform.device
-        if es_device:
-            device += "ES"
-
-        # Generate build script
-        script = _build_script(False, self.build_template, build_name, device,
-                               timingstrict, ignoreloops, seed)
-        # Run
-        if run:
-            _run_script(script)
-
-        os.chdir(cwd)
+        # Generated files (verilog, .pdc, .ys, script) are written with relative paths.
+        with _pushd(build_dir):
+            # Finalize design
+            if not isinstance(fragment, _Fragment):
+                fragment = fragment.get_fragment()
+            platform.finalize(fragment)
+
+            # Generate verilog
+            v_output = platform.get_verilog(fragment, name=build_name, **kwargs)
+            named_sc, named_pc = platform.resolve_signals(v_output.ns)
+            top_file = build_name + ".v"
+            v_output.write(top_file)
+            platform.add_source(top_file)
+
+            # Generate design constraints file (.pdc)
+            _build_pdc(named_sc, named_pc, self.clocks, v_output.ns, build_name)
+
+            # Generate Yosys script
+            _build_yosys(self.yosys_template, platform, nowidelut, abc9, build_name)
+
+            # N.B. Radiant does not allow a choice between ES1/production, this is determined
+            # solely by the installed Radiant version. nextpnr/oxide supports both, so we
+            # must choose what we are dealing with
+            device = platform.device
+            if es_device:
+                device += "ES"
+
+            # Generate build commands/script
+            commands = _build_commands(self.build_template, build_name, device,
+                                       timingstrict, ignoreloops, seed)
+            script = _build_script(False, commands, build_name)
+
+            # Run
+            if run:
+                _run_script(script, commands)
 
         return v_output.ns
 
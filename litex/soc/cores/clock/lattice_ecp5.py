@@ -5,11 +5,96 @@
 # Copyright (c) 2021 George Hilliard <thirtythreeforty@gmail.com>
 # SPDX-License-Identifier: BSD-2-Clause
 
+import math
+
 from migen import *
 from migen.genlib.resetsync import AsyncResetSynchronizer
 
 from litex.soc.cores.clock.common import *
 
+# Lattice / ECP5 Config Search ---------------------------------------------------------------------
+
+def _compute_clkout_divs(clkouts, clko_div_range, vco_freq):
+    # Find the first valid divider for each output, None if one of the outputs can't be met.
+    divs = []
+    (clko_div_min, clko_div_max) = clko_div_range
+    for n, f, p, m, dpa in clkouts:
+        tolerance = f*m
+        # Valid dividers are contiguous and the first one is ceil(vco_freq/(f + tolerance)):
+        # only check it and its neighbours (to absorb float rounding) instead of all dividers.
+        d_start = max(clko_div_min, math.ceil(vco_freq/(f + tolerance)) - 1)
+        for d in range(d_start, min(d_start + 3, clko_div_max)):
+            clk_freq = vco_freq/d
+            if abs(clk_freq - f) <= tolerance:
+                divs.append((d, clk_freq))
+                break
+        else:
+            return None
+    return divs
+
+def _search_config(clkin_freq, clkouts, dpa_en, nclkouts_max,
+    clki_div_range, clkfb_div_range, clko_div_range, vco_freq_range, pfd_freq_range):
+    # Pure function of the PLL inputs/ranges (no Signals), see ECP5PLL._search_config_args.
+    config = {}
+    (pfd_freq_min, pfd_freq_max) = pfd_freq_range
+    (vco_freq_min, vco_freq_max) = vco_freq_range
+    (clki_div_min, clki_div_max) = clki_div_range
+    (clkfb_div_min, clkfb_div_max) = clkfb_div_range
+    (clko_div_min, clko_div_max) = clko_div_range
+    # Restrict CLKI dividers to the PFD range (bounds are rounded outwards, exact check below).
+    clki_div_lo = max(clki_div_min, math.floor(clkin_freq/pfd_freq_max))
+    clki_div_hi = min(clki_div_max, math.ceil(clkin_freq/pfd_freq_min) + 1)
+    # Iterate on CLKI dividers...
+    for clki_div in range(clki_div_lo, clki_div_hi):
+        # Check if in PFD range.
+        pfd_freq = clkin_freq/clki_div
+        if not (pfd_freq_min <= pfd_freq <= pfd_freq_max):
+            continue
+        config["clki_div"] = clki_div
+        # Restrict CLKFB*CLKOFB product to the VCO range (rounded outwards, exact check below).
+        product_lo = math.floor(vco_freq_min/pfd_freq)
+        product_hi = math.ceil(vco_freq_max/pfd_freq)
+        # Outputs dividers only depend on the VCO frequency, so on the CLKFB*CLKOFB product:
+        # evaluate them once per product and reuse them for all (CLKFB, CLKOFB) pairs.
+        clkout_divs = {}
+        # Iterate on CLKO dividers... (to get us in VCO range)
+        for clkofb_div in range(clko_div_min, min(clko_div_max, product_hi + 1)):
+            clkfb_div_lo = max(clkfb_div_min, product_lo//clkofb_div)
+            clkfb_div_hi = min(clkfb_div_max, -(-product_hi//clkofb_div) + 1)
+            # Iterate on CLKFB dividers...
+            for clkfb_div in range(clkfb_div_lo, clkfb_div_hi):
+                vco_freq = (clkin_freq/clki_div)*clkfb_div*clkofb_div
+                # If not in VCO range, skip.
+                if not (vco_freq_min <= vco_freq <= vco_freq_max):
+                    continue
+                # Find dividers for all outputs, skip if one of the outputs can't be met.
+                product = clkfb_div*clkofb_div
+                if product not in clkout_divs:
+                    clkout_divs[product] = _compute_clkout_divs(clkouts, clko_div_range, vco_freq)
+                divs = clkout_divs[product]
+                if divs is None:
+                    continue
+                config["clkfb"] = None
+                for (n, f, p, m, dpa), (d, clk_freq) in zip(clkouts, divs):
+                    config["clko{}_freq".format(n)]  = clk_freq
+                    config["clko{}_div".format(n)]   = d
+                    config["clko{}_phase".format(n)] = p
+                    # Check if ouptut can be used as feedback, if so use it.
+                    # (We cannot use clocks with dynamic phase adjustment enabled)
+                    if (d == clkofb_div) and (not (dpa and dpa_en)):
+                        config["clkfb"] = n
+                # If no output suitable for feedback, create a new output for it.
+                if config["clkfb"] is None:
+                    # We need at least a free output...
+                    nclkouts = len(clkouts)
+                    assert nclkouts < nclkouts_max
+                    config["clkfb"] = nclkouts
+                    config[f"clko{nclkouts}_div"] = int((vco_freq*clki_div)/(clkin_freq*clkfb_div))
+                config["vco"]       = vco_freq
+                config["clkfb_div"] = clkfb_div
+                return config
+    raise ValueError("No PLL config found")
+
 # Lattice / ECP5 -----------------------------------------------------------------------------------
 
 class ECP5PLL(Module):
@@ -22,6 +107,15 @@ class ECP5PLL(Module):
     vco_freq_range  = (  400e6,  800e6)
     pfd_freq_range  = (   10e6,  400e6)
 
+    # Instance parameters names for each output (ENABLE, DIV, FPHASE, CPHASE, CLKO).
+    _clko_params = {l: (
+        f"p_CLKO{l}_ENABLE",
+        f"p_CLKO{l}_DIV",
+        f"p_CLKO{l}_FPHASE",
+        f"p_CLKO{l}_CPHASE",
+        f"o_CLKO{l}",
+    ) for l in ("P", "S", "S2", "S3")}
+
     def __init__(self):
         self.logger = logging.getLogger("ECP5PLL")
         self.logger.info("Creating ECP5PLL.")
@@ -61,57 +155,24 @@ class ECP5PLL(Module):
         create_clkout_log(self.logger, cd.name, freq, margin, self.nclkouts)
         self.nclkouts += 1
 
+    def _search_config_args(self):
+        # Outputs are registered with sequential keys, so dict order is already sorted. A dedicated
+        # feedback output (created by a previous config) is not part of the search inputs.
+        clkouts = tuple((n, f, p, m, dpa) for n, (_, f, p, m, dpa) in self.clkouts.items()
+            if n < self.nclkouts)
+        return (self.clkin_freq, clkouts, self.dpa_en, self.nclkouts_max,
+            self.clki_div_range, self.clkfb_div_range, self.clko_div_range,
+            self.vco_freq_range, self.pfd_freq_range)
+
     def compute_config(self):
-        config = {}
-        # Iterate on CLKI dividers...
-        for clki_div in range(*self.clki_div_range):
-            # Check if in PFD range.
-            (pfd_freq_min, pfd_freq_max) = self.pfd_freq_range
-            if not (pfd_freq_min <= self.clkin_freq/clki_div <= pfd_freq_max):
-                continue
-            config["clki_div"] = clki_div
-            # Iterate on CLKO dividers... (to get us in VCO range)
-            for clkofb_div in range(*self.clko_div_range):
-                # Iterate on CLKFB dividers...
-                for clkfb_div in range(*self.clkfb_div_range):
-                    vco_freq = (self.clkin_freq/clki_div)*clkfb_div*clkofb_div
-                    (vco_freq_min, vco_freq_max) = self.vco_freq_range
-                    all_valid = True
-                    # If in VCO range, find dividers for all outputs.
-                    if vco_freq_min <= vco_freq <= vco_freq_max:
-                        config["clkfb"] = None
-                        for n, (clk, f, p, m, dpa) in sorted(self.clkouts.items()):
-                            valid = False
-                            for d in range(*self.clko_div_range):
-                                clk_freq = vco_freq/d
-                                # If output is valid, save config.
-                                if abs(clk_freq - f) <= f*m:
-                                    config["clko{}_freq".format(n)]  = clk_freq
-                                    config["clko{}_div".format(n)]   = d
-                                    config["clko{}_phase".format(n)] = p
-                                    valid = True
-                                    # Check if ouptut can be used as feedback, if so use it.
-                                    # (We cannot use clocks with dynamic phase adjustment enabled)
-                                    if (d == clkofb_div) and (not (dpa and self.dpa_en)):
-                                        config["clkfb"] = n
-                                    break
-                            if not valid:
-                                all_valid = False
-                    else:
-                        all_valid = False
-                    if all_valid:
-                        # If no output suitable for feedback, create a new output for it.
-                        if config["clkfb"] is None:
-                            # We need at least a free output...
-                            assert self.nclkouts < self.nclkouts_max
-                            config["clkfb"] = self.nclkouts
-                            self.clkouts[self.nclkouts] = (Signal(), 0, 0, 0, 0)
-                            config[f"clko{self.nclkouts}_div"] = int((vco_freq*clki_div)/(self.clkin_freq*clkfb_div))
-                        config["vco"]       = vco_freq
-                        config["clkfb_div"] = clkfb_div
-                        compute_config_log(self.logger, config)
-                        return config
-        raise ValueError("No PLL config found")
+        config = _search_config(*self._search_config_args())
+        # If no output was suitable for feedback, create a new output for it (and remove the one
+        # from a previous config otherwise).
+        self.clkouts.pop(self.nclkouts, None)
+        if config["clkfb"] == self.nclkouts:
+            self.clkouts[self.nclkouts] = (Signal(), 0, 0, 0, 0)
+        compute_config_log(self.logger, config)
+        return config
 
     def expose_dpa(self):
         self.dpa_en     = True
@@ -151,12 +212,13 @@ class ECP5PLL(Module):
             p_CLKI_DIV      = config["clki_div"]
         )
         self.comb += self.locked.eq(locked & ~self.reset)
-        for n, (clk, f, p, m, dpa) in sorted(self.clkouts.items()):
+        for n, (clk, f, p, m, dpa) in self.clkouts.items():
             div    = config[f"clko{n}_div"]
             cphase = int(p*(div + 1)/360 + div - 1)
-            self.params[f"p_CLKO{n_to_l[n]}_ENABLE"] = "ENABLED"
-            self.params[f"p_CLKO{n_to_l[n]}_DIV"]    = div
-            self.params[f"p_CLKO{n_to_l[n]}_FPHASE"] = 0
-            self.params[f"p_CLKO{n_to_l[n]}_CPHASE"] = cphase
-            self.params[f"o_CLKO{n_to_l[n]}"]        = clk
+            (p_enable, p_div, p_fphase, p_cphase, o_clko) = self._clko_params[n_to_l[n]]
+            self.params[p_enable] = "ENABLED"
+            self.params[p_div]    = div
+            self.params[p_fphase] = 0
+            self.params[p_cphase] = cphase
+            self.params[o_clko]   = clk
         self.specials += Instance("EHXPLLL", **self.params)
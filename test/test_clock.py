@@ -121,6 +121,23 @@ class TestClock(unittest.TestCase):
         pll.expose_dpa()
         pll.compute_config()
 
+    def ecp5pll(self, *freqs):
+        pll = ECP5PLL()
+        pll.register_clkin(Signal(), 100e6)
+        for i, freq in enumerate(freqs):
+            pll.create_clkout(ClockDomain("clkout{}".format(i)), freq)
+        return pll
+
+    def test_ecp5pll_clkout_after_compute_config(self):
+        # Adding an output after compute_config must be taken into account by do_finalize.
+        pll = self.ecp5pll(50e6)
+        pll.compute_config()
+        pll.create_clkout(ClockDomain("clkout1"), 25e6)
+        pll.finalize()
+        expected = self.ecp5pll(50e6, 25e6).compute_config()
+        self.assertEqual(pll.params["p_CLKOP_DIV"], expected["clko0_div"])
+        self.assertEqual(pll.params["p_CLKOS_DIV"], expected["clko1_div"])
+
     # Lattice / NX
     def test_nxpll(self):
         pll = NXPLL()
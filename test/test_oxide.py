@@ -0,0 +1,113 @@
+#
+# This file is part of LiteX.
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from litex.build.lattice import oxide
+
+
+class TestOxide(unittest.TestCase):
+    def setUp(self):
+        # Scripts are generated in the current directory.
+        cwd = os.getcwd()
+        build_dir = tempfile.TemporaryDirectory()
+        os.chdir(build_dir.name)
+        self.addCleanup(build_dir.cleanup)
+        self.addCleanup(os.chdir, cwd)
+        revision = mock.patch.object(oxide.tools, "get_litex_git_revision", return_value="0000000")
+        revision.start()
+        self.addCleanup(revision.stop)
+
+    def build(self, platform, build_template=oxide._build_template, build_name="top",
+        timingstrict=False, ignoreloops=False):
+        with mock.patch.object(oxide.sys, "platform", platform):
+            commands = oxide._build_commands(build_template, build_name, "LIFCL-40-9BG400C",
+                timingstrict, ignoreloops, 1)
+            script   = oxide._build_script(False, commands, build_name)
+        with open(script) as f:
+            return commands, script, f.read()
+
+    def test_default_template_linux(self):
+        commands, script, contents = self.build("linux")
+        self.assertEqual(commands, [
+            ["yosys", "-l", "top.rpt", "top.ys"],
+            (["nextpnr-nexus", "--json", "top.json", "--pdc", "top.pdc", "--fasm", "/dev/stdout",
+              "--device", "LIFCL-40-9BG400C", "--timing-allow-fail", "--seed", "1"],
+             ["prjoxide", "pack", "/dev/stdin", "top.bit"]),
+        ])
+        self.assertEqual(script, "build_top.sh")
+        self.assertEqual(contents,
+            "# Autogenerated by LiteX / git: 0000000\n"
+            "set -e\n"
+            "set -o pipefail\n"
+            "yosys -l top.rpt top.ys\n"
+            "nextpnr-nexus --json top.json --pdc top.pdc --fasm /dev/stdout "
+            "--device LIFCL-40-9BG400C --timing-allow-fail --seed 1 "
+            "| prjoxide pack /dev/stdin top.bit\n")
+
+    def test_default_template_win32(self):
+        commands, script, contents = self.build("win32")
+        self.assertEqual(commands, [
+            ["yosys", "-l", "top.rpt", "top.ys"],
+            ["nextpnr-nexus", "--json", "top.json", "--pdc", "top.pdc", "--fasm", "top.fasm",
+             "--device", "LIFCL-40-9BG400C", "--timing-allow-fail", "--seed", "1"],
+            ["prjoxide", "pack", "top.fasm", "top.bit"],
+        ])
+        self.assertEqual(script, "build_top.bat")
+        self.assertEqual(contents,
+            "@echo off\n"
+            "rem Autogenerated by LiteX / git: 0000000\n"
+            "\n"
+            "yosys -l top.rpt top.ys || exit /b\n"
+            "nextpnr-nexus --json top.json --pdc top.pdc --fasm top.fasm "
+            "--device LIFCL-40-9BG400C --timing-allow-fail --seed 1 || exit /b\n"
+            "prjoxide pack top.fasm top.bit || exit /b\n")
+
+    def test_optional_flags(self):
+        for platform in ["linux", "win32"]:
+            commands, _, _ = self.build(platform, timingstrict=True, ignoreloops=False)
+            nextpnr = commands[1][0] if platform == "linux" else commands[1]
+            self.assertNotIn("", nextpnr)
+            self.assertNotIn("--timing-allow-fail", nextpnr)
+            self.assertNotIn("--ignore-loops", nextpnr)
+            commands, _, _ = self.build(platform, timingstrict=False, ignoreloops=True)
+            nextpnr = commands[1][0] if platform == "linux" else commands[1]
+            self.assertIn("--timing-allow-fail", nextpnr)
+            self.assertIn("--ignore-loops", nextpnr)
+
+    def test_quoting(self):
+        _, _, contents = self.build("linux", build_name="my top")
+        self.assertIn("yosys -l 'my top.rpt' 'my top.ys'\n", contents)
+        _, _, contents = self.build("win32", build_name="my top")
+        self.assertIn("yosys -l \"my top.rpt\" \"my top.ys\" || exit /b\n", contents)
+
+    def test_mixed_template(self):
+        build_template = [
+            ["yosys", "-l", "{build_name}.rpt", "{build_name}.ys"],
+            "FOO=1 nextpnr-nexus --json {build_name}.json {timefailarg} && echo done",
+        ]
+        for platform, fail_stmt in [("linux", ""), ("win32", " || exit /b")]:
+            commands, script, contents = self.build(platform, build_template)
+            self.assertEqual(commands, [
+                ["yosys", "-l", "top.rpt", "top.ys"],
+                "FOO=1 nextpnr-nexus --json top.json --timing-allow-fail && echo done",
+            ])
+            self.assertTrue(contents.endswith(
+                "yosys -l top.rpt top.ys" + fail_stmt + "\n" +
+                commands[1] + fail_stmt + "\n"))
+            # Templates with string entries are run through the script with a shell.
+            shell = ["bash"] if platform == "linux" else ["cmd", "/c"]
+            with mock.patch.object(oxide.sys, "platform", platform), \
+                 mock.patch.object(oxide, "which", return_value="/usr/bin/tool"), \
+                 mock.patch.object(oxide.subprocess, "call", return_value=0) as call:
+                oxide._run_script(script, commands)
+            call.assert_called_once_with(shell + [script])
+
+    def test_fail_stmt_string_template(self):
+        commands, _, _ = self.build("win32", ["yosys {build_name}.ys{fail_stmt}"])
+        self.assertEqual(commands, ["yosys top.ys || exit /b"])